@@ -1,7 +1,29 @@
-import inspect, bson, re
+import inspect, bson, re, itertools, atexit, calendar, datetime, json, struct, tempfile, \
+    threading, time, Queue
 from mongoengine import *
 from mongoengine.base import get_document
-from pymongo import ASCENDING, DESCENDING
+from pymongo import ASCENDING, DESCENDING, InsertOne, DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+
+# How DocumentTagRefs encode their document (see DocumentTagRefs.encoding).
+GENERIC_REFS, DUAL_REFS, COMPACT_REFS = 'generic', 'dual', 'compact'
+
+# Document side indexes of generic refs, replaced by partial ones with the same keys but other
+# names with compact refs.
+GENERIC_REFS_INDEXES = ['document_1_tag_1', 'document._cls_1']
+COMPACT_REFS_INDEXES = ['document_1_tag_1_partial', 'document._cls_1_partial']
+
+# Tag graph files (see export_graph()).
+GRAPH_MAGIC, GRAPH_VERSION = 'TAGGRAPH', 1
+
+GRAPH_HEADER = struct.Struct('<8sIIQQ')
+GRAPH_EDGE_COLUMNS = [          # Name, NumPy dtype and struct format of each edge column.
+    ('documents', '<i4', 'i'),
+    ('tags', '<i4', 'i'),
+    ('tagged_at', '<i8', 'q'),
+    ('expires_at', '<i8', 'q')
+]
 
 
 def klass(class_object_or_name):
@@ -65,15 +87,349 @@ def find(f, seq):
       return item
 
 
-def create_document_tag_refs_cls_indexes():
-    DocumentTagRefs._get_collection().ensure_index('document._cls')
+def limited_types(allowed_types):
+    """ Returns the entries of an allowed_tags/allowed_documents definition that carry a maximum
+    limit. Only 'only' entries may, for dicts. """
+
+    if isinstance(allowed_types, dict):
+        allowed_types = allowed_types.get('only', [])
+
+    return [allowed_type for allowed_type in allowed_types if extract_max_refs(allowed_type) != -1]
+
+
+_document_type_codes = {}
+_document_type_names = {}
+
+
+def _cache_document_type_code(type_code):
+    _document_type_codes[type_code.name] = type_code.code
+    _document_type_names[type_code.code] = type_code.name
+
+
+def clear_document_type_codes_cache():
+    _document_type_codes.clear()
+    _document_type_names.clear()
+
+
+def document_type_code(name, create=True):
+    """ Returns the code compact refs store for a MongoDB class name (as returned by
+    mongodb_compound_class_name()), allocating one if needed and create is True, or None
+    otherwise. Codes never change once allocated, so they are cached. """
+
+    if name not in _document_type_codes:
+        type_code = DocumentTypeCode.objects(name=name).first()
+
+        while type_code is None and create:
+            last_type_code = DocumentTypeCode.objects.order_by('-code').first()
+
+            try:
+                type_code = DocumentTypeCode(
+                    name=name, code=last_type_code.code + 1 if last_type_code else 1).save()
+            except NotUniqueError:
+                # Another process allocated either this name or this code first. Look again.
+                type_code = DocumentTypeCode.objects(name=name).first()
+
+        if type_code is None:
+            return None
+
+        _cache_document_type_code(type_code)
+
+    return _document_type_codes[name]
+
+
+def document_type_name(code):
+    if code not in _document_type_names:
+        _cache_document_type_code(DocumentTypeCode.objects.get(code=code))
+
+    return _document_type_names[code]
+
+
+def generic_document_ref(document_class, document_id):
+    """ The { _cls, _ref } value a GenericReferenceField stores for a document. """
+
+    document_class = klass(document_class)
+
+    return bson.son.SON([
+        ('_cls', document_class._class_name),
+        ('_ref', bson.DBRef(document_class._get_collection_name(), document_id))
+    ])
+
+
+def document_ref_update(document_class, document_id, encoding=None):
+    """ Raw update pointing a DocumentTagRefs at a document, in the given encoding (by default,
+    DocumentTagRefs.encoding). Fields of the other encoding are removed, except in dual mode. """
+
+    encoding = encoding or DocumentTagRefs.encoding
+    document_class = klass(document_class)
+    update = { '$set': {}, '$unset': {} }
+
+    if encoding == COMPACT_REFS:
+        update['$unset']['document'] = ''
+    else:
+        update['$set']['document'] = generic_document_ref(document_class, document_id)
+
+    if encoding == GENERIC_REFS:
+        update['$unset'].update({ 'document_id': '', 'document_type': '' })
+    else:
+        update['$set'].update({
+            'document_id': document_id,
+            'document_type': document_type_code(mongodb_compound_class_name(document_class))
+        })
+
+    return dict((operator, fields) for operator, fields in update.items() if fields)
+
+
+def document_ref_query(document):
+    """ Raw query matching the DocumentTagRefs where document is on the document side. """
+
+    return documents_ref_query([document])
+
+
+def documents_ref_query(documents, document_type=None):
+    """ Raw query matching the DocumentTagRefs where any of documents, given as document
+    instances, (MongoDB class name, id) keys as returned by raw_document_key() or ids, is on the
+    document side. Dual mode matches both encodings.
+
+    Generic refs are matched on whole { _cls, _ref } values, which the (document, tag) index
+    covers, so ids need the document_type they belong to (subclasses included). """
+
+    ids = [
+        document.pk if isinstance(document, Document) else
+        document[1] if isinstance(document, tuple) else document
+        for document in documents
+    ]
+    queries = []
+
+    if DocumentTagRefs.encoding != COMPACT_REFS:
+        if documents and isinstance(documents[0], Document):
+            queries.append({ 'document': {
+                '$in': [DocumentTagRefs(document=document).to_mongo()['document']
+                        for document in documents]
+            } })
+        elif documents and isinstance(documents[0], tuple):
+            # Matching whole { _cls, _ref } values keeps to the (document, tag) index.
+            queries.append({ 'document': {
+                '$in': [generic_document_ref(*key) for key in documents]
+            } })
+        elif document_type is not None:
+            class_names = [
+                mongodb_compound_class_name(cls)
+                for cls in [klass(document_type)] + descendants(klass(document_type))
+            ]
+            queries.append({ 'document': {
+                '$in': [generic_document_ref(class_name, document_id)
+                        for document_id in ids for class_name in class_names]
+            } })
+        elif ids:
+            raise ValueError("document_type is required to look up generic refs by id.")
+        else:
+            queries.append({ 'document': { '$in': [] } })
+
+    if DocumentTagRefs.encoding != GENERIC_REFS:
+        queries.append({ 'document_id': { '$in': ids } })
+
+    return queries[0] if len(queries) == 1 else { '$or': queries }
+
+
+def document_types_ref_query(mongodb_class_names):
+    """ Raw query matching the DocumentTagRefs whose document has one of the given MongoDB class
+    names. """
+
+    queries = []
+
+    if DocumentTagRefs.encoding != COMPACT_REFS:
+        queries.append({ 'document._cls': { '$in': mongodb_class_names } })
+
+    if DocumentTagRefs.encoding != GENERIC_REFS:
+        codes = [document_type_code(name, False) for name in mongodb_class_names]
+        queries.append({ 'document_type': { '$in': [code for code in codes if code] } })
+
+    return queries[0] if len(queries) == 1 else { '$or': queries }
+
+
+def live_refs_query(query):
+    """ Restricts a raw DocumentTagRefs query to refs that have not expired. MongoDB's TTL monitor
+    only removes expired refs about once a minute, so reads (and, through them, maximum limit
+    checks) must leave them out themselves. """
+
+    return { '$and': [query, { '$or': [
+        { 'expires_at': None },
+        { 'expires_at': { '$gt': datetime.datetime.utcnow() } }
+    ] }] }
+
+
+def delete_expired_refs(query):
+    """ Deletes the expired refs among those matching a raw DocumentTagRefs query, ahead of the TTL
+    monitor. Returns how many were deleted. """
+
+    query = { '$and': [query, { 'expires_at': { '$lte': datetime.datetime.utcnow() } }] }
+
+    return DocumentTagRefs._get_collection().delete_many(query).deleted_count
+
+
+def raw_document_key(raw_ref):
+    """ (MongoDB class name, id) of the document a raw (as stored) DocumentTagRefs points at,
+    whatever its encoding. """
+
+    if raw_ref.get('document_id') is not None:
+        return (document_type_name(raw_ref['document_type']), raw_ref['document_id'])
+
+    return (raw_ref['document']['_cls'], raw_ref['document']['_ref'].id)
+
+
+def referenced_documents(raw_refs):
+    """ Loads the documents a sequence of raw DocumentTagRefs point at, in order, with one query
+    per document class. Documents that no longer exist are left out. """
+
+    keys = [raw_document_key(raw_ref) for raw_ref in raw_refs]
+    ids_by_class_name = {}
+    documents = {}
+
+    for class_name, document_id in keys:
+        ids_by_class_name.setdefault(class_name, []).append(document_id)
+
+    for class_name, ids in ids_by_class_name.items():
+        for document in klass(class_name).objects(id__in=ids):
+            documents[(class_name, document.pk)] = document
+
+    return [documents[key] for key in keys if key in documents]
+
+
+def migrate_document_tag_refs(encoding=COMPACT_REFS, batch_size=1000, pause=0):
+    """ Rewrites the existing DocumentTagRefs into encoding, batch_size at a time, sleeping pause
+    seconds between batches, and returns how many were rewritten. Moving from generic to compact
+    refs without downtime goes:
+
+    1. Set DocumentTagRefs.encoding to DUAL_REFS in every process, so new refs get both encodings
+       and reads accept either.
+    2. Run migrate_document_tag_refs(DUAL_REFS) to create the unique (document_id, tag) index
+       and add the compact fields to older refs.
+    3. Run migrate_document_tag_refs(COMPACT_REFS). It drops the unique document_1_tag_1 and
+       document._cls_1 indexes, which refs without a generic reference would collide on, and
+       only then creates their partial replacements, since MongoDB before 5.0 rejects two
+       indexes on the same keys. Meanwhile, the (document_id, tag) index from step 2 keeps refs
+       unique. It then drops the generic references.
+    4. Set DocumentTagRefs.encoding to COMPACT_REFS everywhere.
+
+    Migrating back to generic refs drops the partial indexes once all refs have their generic
+    reference again, before recreating the original ones. Partial indexes need MongoDB 3.2 or
+    later. Running it again resumes an interrupted migration. """
+
+    collection = DocumentTagRefs._get_collection()
+
+    if encoding != GENERIC_REFS:
+        create_document_tag_refs_cls_indexes(DUAL_REFS)
+
+    if encoding == COMPACT_REFS:
+        _drop_indexes(collection, GENERIC_REFS_INDEXES)
+        create_document_tag_refs_cls_indexes(COMPACT_REFS)
+
+    if encoding == GENERIC_REFS:
+        query = { '$or': [{ 'document': None }, { 'document_id': { '$ne': None } }] }
+    elif encoding == DUAL_REFS:
+        query = { '$or': [{ 'document': None }, { 'document_id': None }] }
+    else:
+        query = { '$or': [{ 'document': { '$ne': None } }, { 'document_id': None }] }
+
+    migrated = 0
+
+    while True:
+        raw_refs = list(collection.find(query).limit(batch_size))
+
+        if not raw_refs:
+            if encoding == GENERIC_REFS:
+                _drop_indexes(collection, COMPACT_REFS_INDEXES)
+
+            if encoding != COMPACT_REFS:
+                create_document_tag_refs_cls_indexes(encoding)
+
+            return migrated
+
+        requests = [
+            UpdateOne({ '_id': raw_ref['_id'] },
+                      document_ref_update(*raw_document_key(raw_ref), encoding=encoding))
+            for raw_ref in raw_refs
+        ]
+
+        try:
+            collection.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            # A ref already exists for the same pair in the target encoding (e.g. written by a
+            # process still running the previous mode), so this one is redundant.
+            for write_error in e.details['writeErrors']:
+                if write_error.get('code') not in (11000, 11001):
+                    raise
+
+                collection.delete_one({ '_id': raw_refs[write_error['index']]['_id'] })
+
+        migrated += len(raw_refs)
+
+        if pause:
+            time.sleep(pause)
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+
+        if not chunk:
+            return
+
+        yield chunk
+
+
+def _drop_indexes(collection, names):
+    indexes = collection.index_information()
+
+    for name in names:
+        if name in indexes:
+            collection.drop_index(name)
+
+
+def create_document_tag_refs_cls_indexes(encoding=None):
+    """ Creates the DocumentTagRefs indexes on the document side, which depend on the encoding
+    (by default, DocumentTagRefs.encoding) and so are not in its meta definition. MongoEngine
+    doesn't seem to allow the document._cls one there anyway. It is called automatically the
+    first time the collection is used.
+
+    Generic and dual refs keep the original indexes; compact refs use partial ones under new
+    names instead, so only the refs of each encoding get indexed. Since both have the same keys,
+    the ones of the other encoding are left alone if present: only migrate_document_tag_refs()
+    swaps them. """
+
+    encoding = encoding or DocumentTagRefs.encoding
+    collection = DocumentTagRefs._get_collection()
+    indexes = collection.index_information()
+    generic_refs_only = { 'document': { '$exists': True } }
+    compact_refs_only = { 'document_id': { '$exists': True } }
+
+    if encoding == COMPACT_REFS:
+        if not set(GENERIC_REFS_INDEXES) & set(indexes):
+            collection.ensure_index([('document', ASCENDING), ('tag', ASCENDING)], unique=True,
+                name='document_1_tag_1_partial', partialFilterExpression=generic_refs_only)
+            collection.ensure_index('document._cls', name='document._cls_1_partial',
+                partialFilterExpression=generic_refs_only)
+    elif not set(COMPACT_REFS_INDEXES) & set(indexes):
+        collection.ensure_index([('document', ASCENDING), ('tag', ASCENDING)], unique=True)
+        collection.ensure_index('document._cls')
+
+    if encoding != GENERIC_REFS:
+        collection.ensure_index([('document_id', ASCENDING), ('tag', ASCENDING)], unique=True,
+            partialFilterExpression=compact_refs_only)
+        collection.ensure_index([('tag', ASCENDING), ('document_type', ASCENDING)],
+            partialFilterExpression=compact_refs_only)
 
 
 def recreate_indexes():
     create_document_tag_refs_cls_indexes()
-    DocumentTagRefs._get_collection().ensure_index(
-        [('document', ASCENDING), ('tag', ASCENDING)], unique=True)
     DocumentTagRefs._get_collection().ensure_index('tag')
+    DocumentTagRefs._get_collection().ensure_index(
+        [('tag', ASCENDING), ('tagged_at', DESCENDING), ('_id', DESCENDING)])
+    DocumentTagRefs._get_collection().ensure_index('expires_at', expireAfterSeconds=0)
+    DocumentTypeCode._get_collection().ensure_index('name', unique=True)
+    DocumentTypeCode._get_collection().ensure_index('code', unique=True)
     Tag._get_collection().ensure_index([('_cls', ASCENDING), ('name', ASCENDING)], unique=True)
 
 
@@ -81,20 +437,20 @@ class TaggableDocument(object):
     allowed_tags = ['Tag']
 
     def tags(self):
-        refs = DocumentTagRefs.objects(document=self)
+        refs = DocumentTagRefs.objects(__raw__=live_refs_query(document_ref_query(self)))
 
         return [ref.tag for ref in refs]
 
     def tags_by_type(self, tag_type):
         return [tag for tag in self.tags() if isinstance(tag, klass(tag_type))]
 
-    def add_tag(self, tag):
+    def add_tag(self, tag, expires_at=None):
         if not isinstance(tag, Tag):
             raise TypeError("Invalid type %s. Only tags are allowed in document '%s'." %
                 (type(tag).__name__, self))
 
         if self.can_add_tag(tag):
-            return tag.add_document(self)
+            return tag.add_document(self, expires_at)
 
     def can_add_tag(self, tag, document_already_verified=False):
         match = self._check_if_tag_allowed(tag)
@@ -147,16 +503,55 @@ class TaggableDocument(object):
 
 
 class DocumentTagRefs(Document):
+    # GENERIC_REFS store the document in a GenericReferenceField ({ _cls, _ref: DBRef }), while
+    # COMPACT_REFS store its id plus the DocumentTypeCode of its class. DUAL_REFS write both and
+    # read either, while migrating (see migrate_document_tag_refs()).
+    encoding = GENERIC_REFS
+
     document = GenericReferenceField()
+    document_id = ObjectIdField()
+    document_type = IntField()
     tag = ReferenceField('Tag')
+    tagged_at = DateTimeField(default=datetime.datetime.utcnow)
+    expires_at = DateTimeField()        # Removed by MongoDB's TTL monitor once past.
 
+    # Indexes on the document side depend on the encoding, see
+    # create_document_tag_refs_cls_indexes().
     meta = {
         'indexes': [
-            { 'fields': ['document', 'tag'], 'unique': True },
-            'tag'
+            'tag',
+            { 'fields': ['tag', '-tagged_at', '-id'] },
+            { 'fields': ['expires_at'], 'expireAfterSeconds': 0 }
         ]
     }
 
+    @classmethod
+    def ensure_indexes(cls):
+        super(DocumentTagRefs, cls).ensure_indexes()
+        create_document_tag_refs_cls_indexes()
+
+    @classmethod
+    def for_document(cls, document, tag, expires_at=None):
+        ref = cls(tag=tag, expires_at=expires_at)
+
+        if cls.encoding != COMPACT_REFS:
+            ref.document = document
+
+        if cls.encoding != GENERIC_REFS:
+            ref.document_id = document.pk
+            ref.document_type = document_type_code(mongodb_compound_class_name(type(document)))
+
+        return ref
+
+
+class DocumentTypeCode(Document):
+    """ Registry of the small integer codes compact DocumentTagRefs use in place of the MongoDB
+    class names of their documents. """
+
+    name = StringField(required=True, unique=True)
+    code = IntField(required=True, unique=True)
+
+
 class Tag(Document, TaggableDocument):
     allowed_documents = [TaggableDocument]
 
@@ -170,9 +565,9 @@ class Tag(Document, TaggableDocument):
     }
 
     def documents(self):
-        refs = DocumentTagRefs.objects(tag=self)
+        refs = DocumentTagRefs.objects(__raw__=live_refs_query({ 'tag': self.id }))
 
-        return [ref.document for ref in refs]
+        return referenced_documents(refs.as_pymongo())
 
     def documents_by_type(self, document_type):
         document_type_and_descendants_mongodb_names = [
@@ -180,22 +575,60 @@ class Tag(Document, TaggableDocument):
             for cls in [klass(document_type)] + descendants(klass(document_type))
         ]
 
-        refs = DocumentTagRefs.objects(
-            __raw__={
-                'tag': self.id,
-                'document._cls': { '$in': document_type_and_descendants_mongodb_names }
-            }
-        )
+        query = document_types_ref_query(document_type_and_descendants_mongodb_names)
+        query['tag'] = self.id
+
+        refs = DocumentTagRefs.objects(__raw__=live_refs_query(query))
+
+        return referenced_documents(refs.as_pymongo())
+
+    def recent_documents(self, since=None, until=None, limit=20, after=None):
+        """ Returns a page of the documents tagged with this tag, newest first, optionally only
+        those tagged from since on and/or before until, as a (documents, next_page) pair. Pass
+        next_page as after to get the following page; it is None on the last one. Pages are
+        keyset-based, so deep ones cost as little as the first. Refs created before tagged_at
+        was recorded are left out. """
 
-        return [ref.document for ref in refs]
+        tagged_at = { '$ne': None }
 
-    def add_document(self, document):
+        if since:
+            tagged_at['$gte'] = since
+
+        if until:
+            tagged_at['$lt'] = until
+
+        query = { 'tag': self.id, 'tagged_at': tagged_at }
+
+        if after:
+            last_tagged_at, last_id = after
+            query['$or'] = [
+                { 'tagged_at': { '$lt': last_tagged_at } },
+                { 'tagged_at': last_tagged_at, '_id': { '$lt': last_id } }
+            ]
+
+        refs = list(DocumentTagRefs.objects(__raw__=live_refs_query(query))
+            .order_by('-tagged_at', '-id').limit(limit).as_pymongo())
+        next_page = (refs[-1]['tagged_at'], refs[-1]['_id']) if len(refs) == limit else None
+
+        return referenced_documents(refs), next_page
+
+    def add_document(self, document, expires_at=None):
         if not isinstance(document, TaggableDocument):
             raise TypeError("Invalid type %s. Only taggable documents are allowed in tag '%s'." %
                 (type(document).__name__, self))
 
         if self.can_add_document(document):
-            return DocumentTagRefs(document=document, tag=self).save()
+            try:
+                return DocumentTagRefs.for_document(document, self, expires_at).save()
+            except NotUniqueError:
+                # The existing ref may have expired without having been removed yet.
+                query = document_ref_query(document)
+                query['tag'] = self.id
+
+                if not delete_expired_refs(query):
+                    raise
+
+                return DocumentTagRefs.for_document(document, self, expires_at).save()
 
     def can_add_document(self, document, tag_already_verified=False):
         match = self._check_if_document_allowed(document)
@@ -248,5 +681,778 @@ class Tag(Document, TaggableDocument):
                 raise ValueError("Maximum number (%d) of documents of type '%s' exceeded in "
                     "tag '%s'." % (max_documents_allowed, document_type.__name__, self))
 
+    def rename(self, name, **merge_options):
+        """ Renames this tag. If another tag of the same type already has that name, this tag is
+        merged into it instead (see merge_into(), which merge_options are passed to) and the
+        surviving tag is returned. """
+
+        # Tag names are only unique per type.
+        existing = Tag.objects(__raw__={ '_cls': self._class_name, 'name': name }).first()
+
+        if existing is None or existing == self:
+            previous_name = self.name
+            self.name = name
+
+            try:
+                self.validate()
+                self.update(set__name=name)
+            except Exception:
+                self.name = previous_name
+                raise
+
+            return self
+
+        return self.merge_into(existing, **merge_options)
+
+    def merge_into(self, other, batch_size=1000, pause=0, progress=None):
+        """ Moves all refs of this tag over to other, both the ones where it is the tag and the
+        ones where it is the document, then deletes it. Refs other already has are dropped
+        rather than moved, so the unique (document, tag) index is never violated.
+
+        Refs are moved batch_size at a time, sleeping pause seconds between batches. progress,
+        if given, is called after each batch with the number of refs processed so far and the
+        number there were to begin with. Moved refs no longer point at this tag, so calling
+        merge_into() again resumes an interrupted merge. """
+
+        if type(other) is not type(self):
+            raise TypeError("Cannot merge tag '%s' of type '%s' into tag '%s' of type '%s'." %
+                (self, type(self).__name__, other, type(other).__name__))
+
+        if other == self:
+            raise ValueError("Cannot merge tag '%s' into itself." % self)
+
+        # Expired refs would otherwise count as collisions, or be moved over.
+        delete_expired_refs({ 'tag': { '$in': [self.id, other.id] } })
+        delete_expired_refs({ '$or': [document_ref_query(self), document_ref_query(other)] })
+        self._check_if_merge_limits_reached(other)
+
+        total = DocumentTagRefs.objects(tag=self).count() + \
+            DocumentTagRefs.objects(__raw__=document_ref_query(self)).count()
+        processed = self._merge_refs(other, batch_size, pause, progress, 0, total)
+
+        self.delete()
+
+        # Sweep again for refs written to this tag while the last batches were being moved.
+        self._merge_refs(other, batch_size, pause, progress, processed, total)
+
+        return other
+
+    def _merge_refs(self, other, batch_size, pause, progress, processed, total):
+        for move_batch in (self._merge_tag_side_batch, self._merge_document_side_batch):
+            while True:
+                count = move_batch(other, batch_size)
+
+                if not count:
+                    break
+
+                processed += count
+
+                if progress:
+                    progress(processed, total)
+
+                if pause:
+                    time.sleep(pause)
+
+        return processed
+
+    def _check_if_merge_limits_reached(self, other):
+        # Both tags share a class, hence the same rules. Documents tagged with this tag end up
+        # with at most as many tags of its type as before, but other may gain documents and tags
+        # past its own limits.
+        for matched_document in limited_types(self.allowed_documents):
+            document_type = extract_class(matched_document)
+            documents = set(self.documents_by_type(document_type)) | \
+                set(other.documents_by_type(document_type))
+
+            if len(documents) > extract_max_refs(matched_document):
+                raise ValueError("Merging tag '%s' into '%s' exceeds the maximum number (%d) of "
+                    "documents of type '%s'." % (self, other, extract_max_refs(matched_document),
+                    document_type.__name__))
+
+        for matched_tag in limited_types(self.allowed_tags):
+            tag_type = extract_class(matched_tag)
+            tags = set(self.tags_by_type(tag_type)) | set(other.tags_by_type(tag_type))
+
+            if len(tags) > extract_max_refs(matched_tag):
+                raise ValueError("Merging tag '%s' into '%s' exceeds the maximum number (%d) of "
+                    "tags of type '%s'." % (self, other, extract_max_refs(matched_tag),
+                    tag_type.__name__))
+
+    def _merge_tag_side_batch(self, other, batch_size):
+        refs = list(DocumentTagRefs.objects(tag=self).limit(batch_size).as_pymongo())
+        query = documents_ref_query([raw_document_key(ref) for ref in refs])
+        query['tag'] = other.id
+
+        # Also drop refs that would make other tag itself.
+        already_tagged = set(raw_document_key(ref)[1] for ref in DocumentTagRefs.objects(
+            __raw__=query).as_pymongo()) | set([other.id])
+
+        self._move_refs(
+            [ref['_id'] for ref in refs if raw_document_key(ref)[1] not in already_tagged],
+            [ref['_id'] for ref in refs if raw_document_key(ref)[1] in already_tagged],
+            { '$set': { 'tag': other.id } })
+
+        return len(refs)
+
+    def _merge_document_side_batch(self, other, batch_size):
+        refs = list(DocumentTagRefs.objects(__raw__=document_ref_query(self)).limit(batch_size)
+            .as_pymongo())
+        query = document_ref_query(other)
+        query['tag'] = { '$in': [ref['tag'] for ref in refs] }
+
+        already_tagging = set(ref['tag'] for ref in DocumentTagRefs.objects(__raw__=query)
+            .as_pymongo()) | set([other.id])
+
+        self._move_refs(
+            [ref['_id'] for ref in refs if ref['tag'] not in already_tagging],
+            [ref['_id'] for ref in refs if ref['tag'] in already_tagging],
+            document_ref_update(type(other), other.id))
+
+        return len(refs)
+
+    def _move_refs(self, moving_ids, colliding_ids, update):
+        collection = DocumentTagRefs._get_collection()
+
+        if colliding_ids:
+            collection.delete_many({ '_id': { '$in': colliding_ids } })
+
+        if not moving_ids:
+            return
+
+        try:
+            collection.update_many({ '_id': { '$in': moving_ids } }, update)
+        except DuplicateKeyError:
+            # A colliding ref was written concurrently. Move what is left one by one.
+            for ref_id in moving_ids:
+                try:
+                    collection.update_one({ '_id': ref_id }, update)
+                except DuplicateKeyError:
+                    collection.delete_one({ '_id': ref_id })
+
     def __str__(self):
         return self.name
+
+
+def facets(documents, tag_types, top=None, document_type=None, batch_size=10000):
+    """ For the documents given either as a queryset or as an iterable of ids, counts how many
+    are tagged with each tag of every type in tag_types, subclasses included (as in
+    Tag.documents_by_type()). Returns a dict mapping each type's name to a list of (tag, count)
+    pairs, most frequent first, limited to the top ones if given.
+
+    Ids must come with the document_type they belong to (subclasses included), which a queryset
+    already knows. Generic refs are then looked up by every (class name, id) pair, so batches
+    of ids are shrunk to keep each lookup within batch_size values.
+
+    Refs are grouped by tag in a single aggregation per batch, and only the tags actually found
+    are loaded. """
+
+    if isinstance(documents, QuerySet):
+        documents = documents.only('id')
+    elif document_type is None:
+        raise TypeError("facets() requires a document_type when documents are given as ids.")
+    elif DocumentTagRefs.encoding != COMPACT_REFS:
+        batch_size = max(1, batch_size // (1 + len(descendants(klass(document_type)))))
+
+    counts = {}
+
+    for batch in chunks(documents, batch_size):
+        refs = DocumentTagRefs.objects(
+            __raw__=live_refs_query(documents_ref_query(batch, document_type)))
+
+        for group in refs.aggregate(
+                { '$group': { '_id': '$tag', 'count': { '$sum': 1 } } }):
+            counts[group['_id']] = counts.get(group['_id'], 0) + group['count']
+
+    tag_classes = [klass(tag_type) for tag_type in tag_types]
+    tags = Tag.objects(__raw__={
+        '_id': { '$in': list(counts) },
+        '_cls': { '$in': [
+            mongodb_compound_class_name(cls)
+            for tag_class in tag_classes
+            for cls in [tag_class] + descendants(tag_class)
+        ] }
+    }) if counts else []
+    tags = list(tags)
+
+    result = {}
+
+    for tag_class in tag_classes:
+        tag_counts = sorted([(tag, counts[tag.id]) for tag in tags if isinstance(tag, tag_class)],
+                            key=lambda tag_count: (-tag_count[1], tag_count[0].name))
+        result[tag_class.__name__] = tag_counts[:top] if top is not None else tag_counts
+
+    return result
+
+
+class TagOperation(object):
+    """ Handle for an add/remove operation queued in a BufferedTagger. Mimics the relevant part of
+    concurrent.futures.Future: result() and exception() block until the operation is flushed. """
+
+    def __init__(self, action, document, tag, callback=None):
+        self.action = action
+        self.document = document
+        self.tag = tag
+        self.callback = callback
+        self.expires_at = None
+        self.limited = False
+
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        exception = self.exception(timeout)
+
+        if exception:
+            raise exception
+
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError("Tag operation not flushed after %s seconds." % timeout)
+
+        return self._exception
+
+    def _set_result(self, result=None, exception=None):
+        self._result = result
+        self._exception = exception
+        self._done.set()
+
+        if self.callback:
+            try:
+                self.callback(self)
+            except Exception:
+                pass        # A failing callback must not take the flusher thread down.
+
+
+class _FlushRequest(object):
+    def __init__(self, stop=False):
+        self.stop = stop
+        self.event = threading.Event()
+
+
+_open_buffered_taggers = set()
+
+
+@atexit.register
+def _close_buffered_taggers():
+    for tagger in list(_open_buffered_taggers):
+        tagger.close()
+
+
+def _bulk_write_exception(write_error):
+    if write_error.get('code') in (11000, 11001):
+        return NotUniqueError(write_error.get('errmsg'))
+
+    return OperationError(write_error.get('errmsg'))
+
+
+class BufferedTagger(object):
+    """ Write-behind tagger for high-ingest paths. add_tag()/remove_tag() validate type rules
+    right away (raising TypeError like TaggableDocument.add_tag() does) and queue the operation,
+    blocking while max_pending operations are already waiting. A background thread writes the
+    queue to DocumentTagRefs in ordered bulk batches of up to batch_size operations, or whatever
+    has accumulated after flush_interval seconds. Adds subject to a maximum limit are written one
+    by one through Tag.add_document(), since the limit can only be checked against the database.
+
+    Each call returns a TagOperation; write failures (e.g. NotUniqueError) are reported through
+    it and through the optional callback, never raised by the call itself. """
+
+    ADD, REMOVE = 'add', 'remove'
+
+    def __init__(self, batch_size=500, flush_interval=1.0, max_pending=10000, callback=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.callback = callback
+
+        self._queue = Queue.Queue(max_pending)
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='BufferedTagger')
+        self._thread.daemon = True
+        self._thread.start()
+
+        _open_buffered_taggers.add(self)
+
+    def add_tag(self, document, tag, callback=None, timeout=None, expires_at=None):
+        if not isinstance(tag, Tag):
+            raise TypeError("Invalid type %s. Only tags are allowed in document '%s'." %
+                (type(tag).__name__, document))
+
+        if not isinstance(document, TaggableDocument):
+            raise TypeError("Invalid type %s. Only taggable documents are allowed in tag '%s'." %
+                (type(document).__name__, tag))
+
+        tag_match = document._check_if_tag_allowed(tag)
+        document_match = tag._check_if_document_allowed(document)
+
+        operation = self._operation(self.ADD, document, tag, callback)
+        operation.expires_at = expires_at
+        operation.limited = extract_max_refs(tag_match) != -1 or \
+            extract_max_refs(document_match) != -1
+
+        return self._enqueue(operation, timeout)
+
+    def remove_tag(self, document, tag, callback=None, timeout=None):
+        return self._enqueue(self._operation(self.REMOVE, document, tag, callback), timeout)
+
+    def flush(self, timeout=None):
+        """ Blocks until every operation queued before this call has been written. """
+
+        request = self._enqueue(_FlushRequest(), timeout)
+
+        if not request.event.wait(timeout):
+            raise RuntimeError("Buffered tags not flushed after %s seconds." % timeout)
+
+    def close(self, timeout=None):
+        """ Drains the queue and stops the background thread. Also called at interpreter exit
+        for taggers still open. """
+
+        with self._lock:
+            if self._closed:
+                return
+
+            self._closed = True
+            self._queue.put(_FlushRequest(stop=True))
+
+        _open_buffered_taggers.discard(self)
+        self._thread.join(timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _operation(self, action, document, tag, callback):
+        if document.pk is None or tag.pk is None:
+            raise ValueError("Document '%s' and tag '%s' must be saved before being queued." %
+                (document, tag))
+
+        return TagOperation(action, document, tag, callback or self.callback)
+
+    def _enqueue(self, item, timeout):
+        # Holding the lock while blocked on a full queue (backpressure) guarantees nothing gets
+        # queued after close()'s stop request, which would then never be written.
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("BufferedTagger is closed.")
+
+            self._queue.put(item, True, timeout)
+
+        return item
+
+    def _run(self):
+        batch = []
+        deadline = None
+
+        while True:
+            try:
+                item = self._queue.get(True, None if deadline is None else
+                    max(0, deadline - time.time()))
+            except Queue.Empty:
+                item = None
+
+            if isinstance(item, TagOperation):
+                batch.append(item)
+
+                if deadline is None:
+                    deadline = time.time() + self.flush_interval
+
+                if len(batch) < self.batch_size:
+                    continue
+
+            self._write(batch)
+            batch = []
+            deadline = None
+
+            if isinstance(item, _FlushRequest):
+                item.event.set()
+
+                if item.stop:
+                    return
+
+    def _write(self, operations):
+        pending = []
+
+        try:
+            for operation in operations:
+                if operation.action == self.ADD and operation.limited:
+                    self._write_bulk(pending)
+                    pending = []
+                    self._write_single(operation)
+                else:
+                    pending.append(operation)
+
+            self._write_bulk(pending)
+        except Exception as e:
+            for operation in operations:
+                if not operation.done():
+                    operation._set_result(exception=e)
+
+    def _write_single(self, operation):
+        try:
+            ref = operation.tag.add_document(operation.document, operation.expires_at)
+        except Exception as e:
+            operation._set_result(exception=e)
+        else:
+            operation._set_result(ref.id if ref else None)
+
+    def _write_bulk(self, operations):
+        refs = [DocumentTagRefs.for_document(operation.document, operation.tag,
+                                             operation.expires_at).to_mongo()
+                if operation.action == self.ADD else None
+                for operation in operations]
+        requests = [
+            InsertOne(ref) if operation.action == self.ADD else
+            DeleteOne(dict(document_ref_query(operation.document), tag=operation.tag.id))
+            for operation, ref in zip(operations, refs)
+        ]
+
+        # Ordered writes keep add/remove sequences on the same pair consistent. On error, resolve
+        # what was written, fail the offending operation and resume right after it.
+        start = 0
+
+        while start < len(operations):
+            write_error = None
+
+            try:
+                DocumentTagRefs._get_collection().bulk_write(requests[start:], ordered=True)
+                failed = len(operations)
+            except BulkWriteError as e:
+                write_error = e.details['writeErrors'][0]
+                failed = start + write_error['index']
+
+            for i in range(start, failed):
+                operations[i]._set_result(
+                    refs[i]['_id'] if operations[i].action == self.ADD else None)
+
+            start = failed
+
+            if not write_error:
+                break
+
+            # As in Tag.add_document(), the existing ref may have expired without having been
+            # removed yet. Then retry the add.
+            if write_error.get('code') in (11000, 11001) and \
+                    operations[failed].action == self.ADD:
+                query = document_ref_query(operations[failed].document)
+                query['tag'] = operations[failed].tag.id
+
+                if delete_expired_refs(query):
+                    continue
+
+            operations[failed]._set_result(exception=_bulk_write_exception(write_error))
+            start = failed + 1
+
+
+def _milliseconds(moment):
+    if moment is None:
+        return -1
+
+    return calendar.timegm(moment.utctimetuple()) * 1000 + moment.microsecond // 1000
+
+
+def _datetime(milliseconds):
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=milliseconds)
+
+
+def _begin_graph_section(graph):
+    graph.write('\0' * (-graph.tell() % 8))      # Keeps every section 8-byte aligned.
+
+    return graph.tell()
+
+
+def _end_graph_section(graph, offset, **description):
+    description.update(offset=offset, length=graph.tell() - offset)
+
+    return description
+
+
+def _copy_graph_section(graph, column, **description):
+    offset = _begin_graph_section(graph)
+    column.seek(0)
+
+    for data in iter(lambda: column.read(1 << 20), ''):
+        graph.write(data)
+
+    column.close()
+
+    return _end_graph_section(graph, offset, **description)
+
+
+def export_graph(path, batch_size=1000):
+    """ Streams every Tag document and every live DocumentTagRefs into a compact columnar file at
+    path. All integers are little-endian. The file starts with a GRAPH_HEADER (magic, version,
+    reserved, index offset and index length) pointing at a JSON index at its end, which lists the
+    name of every document class ('types') and the offset, length, NumPy dtype and shape of
+    each 8-byte aligned section:
+
+        tags                         Tag documents, as concatenated BSON.
+        edges/<tag class>/documents  int32 id index of the document of every ref to a tag of
+                                     that MongoDB class name.
+        edges/<tag class>/tags       int32 id index of the tag of those refs.
+        edges/<tag class>/tagged_at  int64 milliseconds since the epoch, -1 if unknown.
+        edges/<tag class>/expires_at int64 milliseconds since the epoch, -1 if none.
+        ids                          12-byte ObjectId of every id index.
+        id_types                     int32 position in 'types' of the class of every id index.
+
+    Tags and refs are streamed through temporary files, batch_size tags at a time, so memory only
+    grows with the dictionary of distinct ids. See load_graph() and import_graph(). """
+
+    type_names = []
+    type_indexes = {}
+    ids = {}
+    id_columns = [tempfile.TemporaryFile(), tempfile.TemporaryFile()]
+
+    def id_index(class_name, object_id):
+        if object_id not in ids:
+            if class_name not in type_indexes:
+                type_indexes[class_name] = len(type_names)
+                type_names.append(class_name)
+
+            ids[object_id] = len(ids)
+            id_columns[0].write(object_id.binary)
+            id_columns[1].write(struct.pack('<i', type_indexes[class_name]))
+
+        return ids[object_id]
+
+    tag_collection = Tag._get_collection()
+    sections = {}
+
+    with open(path, 'wb') as graph:
+        graph.write(GRAPH_HEADER.pack(GRAPH_MAGIC, GRAPH_VERSION, 0, 0, 0))
+
+        offset = _begin_graph_section(graph)
+        count = 0
+
+        for raw_tag in tag_collection.find():
+            id_index(raw_tag['_cls'], raw_tag['_id'])
+            graph.write(bson.BSON.encode(raw_tag))
+            count += 1
+
+        sections['tags'] = _end_graph_section(graph, offset, dtype='bson', shape=[count])
+
+        for tag_class_name in sorted(tag_collection.distinct('_cls')):
+            columns = [tempfile.TemporaryFile() for column in GRAPH_EDGE_COLUMNS]
+            count = 0
+            # Tags created since the first pass are not in the file, so leave their refs out.
+            tag_ids = (raw_tag['_id'] for raw_tag in
+                       tag_collection.find({ '_cls': tag_class_name }, { '_id': True })
+                       if raw_tag['_id'] in ids)
+
+            for tag_ids_batch in chunks(tag_ids, batch_size):
+                raw_refs = DocumentTagRefs._get_collection().find(
+                    live_refs_query({ 'tag': { '$in': tag_ids_batch } }))
+
+                for raw_refs_batch in chunks(raw_refs, batch_size):
+                    values = [
+                        [id_index(*raw_document_key(raw_ref)) for raw_ref in raw_refs_batch],
+                        [ids[raw_ref['tag']] for raw_ref in raw_refs_batch],
+                        [_milliseconds(raw_ref.get('tagged_at')) for raw_ref in raw_refs_batch],
+                        [_milliseconds(raw_ref.get('expires_at')) for raw_ref in raw_refs_batch]
+                    ]
+
+                    for column, (name, dtype, pack_format), column_values in \
+                            zip(columns, GRAPH_EDGE_COLUMNS, values):
+                        column.write(struct.pack('<%d%s' % (len(column_values), pack_format),
+                                                 *column_values))
+
+                    count += len(raw_refs_batch)
+
+            for column, (name, dtype, pack_format) in zip(columns, GRAPH_EDGE_COLUMNS):
+                sections['edges/%s/%s' % (tag_class_name, name)] = _copy_graph_section(
+                    graph, column, dtype=dtype, shape=[count])
+
+        sections['ids'] = _copy_graph_section(graph, id_columns[0], dtype='u1',
+                                              shape=[len(ids), 12])
+        sections['id_types'] = _copy_graph_section(graph, id_columns[1], dtype='<i4',
+                                                   shape=[len(ids)])
+
+        index_offset = _begin_graph_section(graph)
+        graph.write(json.dumps({ 'types': type_names, 'sections': sections }))
+        index_length = graph.tell() - index_offset
+
+        graph.seek(0)
+        graph.write(GRAPH_HEADER.pack(GRAPH_MAGIC, GRAPH_VERSION, 0, index_offset, index_length))
+
+
+def read_graph_index(path):
+    """ Returns the JSON index of a file written by export_graph(). """
+
+    with open(path, 'rb') as graph:
+        magic, version, reserved, index_offset, index_length = GRAPH_HEADER.unpack(
+            graph.read(GRAPH_HEADER.size))
+
+        if magic != GRAPH_MAGIC or version != GRAPH_VERSION:
+            raise ValueError("'%s' is not a version %d tag graph file." % (path, GRAPH_VERSION))
+
+        graph.seek(index_offset)
+
+        return json.loads(graph.read(index_length))
+
+
+def load_graph(path):
+    """ Memory-maps the arrays of a file written by export_graph() with NumPy, without touching
+    MongoDB. Returns a (index, arrays) pair, where arrays maps every section name but 'tags' to
+    a read-only array. """
+
+    import numpy
+
+    index = read_graph_index(path)
+    arrays = {}
+
+    for name, section in index['sections'].items():
+        if section['dtype'] == 'bson':
+            continue
+
+        if section['length']:
+            arrays[name] = numpy.memmap(path, dtype=section['dtype'], mode='r',
+                                        offset=section['offset'], shape=tuple(section['shape']))
+        else:
+            arrays[name] = numpy.zeros(section['shape'], dtype=section['dtype'])
+
+    return index, arrays
+
+
+def _read_graph_section(path, section, chunk_size):
+    with open(path, 'rb') as graph:
+        graph.seek(section['offset'])
+        remaining = section['length']
+
+        while remaining:
+            data = graph.read(min(remaining, chunk_size))
+
+            if not data:
+                raise ValueError("Tag graph file '%s' is truncated." % path)
+
+            remaining -= len(data)
+
+            yield data
+
+
+def _read_graph_column(path, section, pack_format, batch_size):
+    item_size = struct.calcsize('<' + pack_format)
+
+    for data in _read_graph_section(path, section, batch_size * item_size):
+        for value in struct.unpack('<%d%s' % (len(data) // item_size, pack_format), data):
+            yield value
+
+
+def _read_graph_bson(path, section):
+    with open(path, 'rb') as graph:
+        graph.seek(section['offset'])
+
+        for i in range(section['shape'][0]):
+            size_data = graph.read(4)
+            data = size_data + graph.read(struct.unpack('<i', size_data)[0] - 4)
+
+            yield bson.BSON(data).decode()
+
+
+def _insert_graph_documents(collection, documents, batch_size):
+    """ Inserts documents with unordered bulk writes, skipping the ones that already exist.
+    Returns how many were inserted. """
+
+    inserted = 0
+
+    for batch in chunks(documents, batch_size):
+        try:
+            inserted += len(collection.insert_many(batch, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            for write_error in e.details['writeErrors']:
+                if write_error.get('code') not in (11000, 11001):
+                    raise
+
+            inserted += e.details['nInserted']
+
+    return inserted
+
+
+def _new_graph_tags(raw_tags, tag_ids, batch_size):
+    """ Filters out the tags of a graph file that already exist, by id or by type and name (tag
+    names are only unique per type). Ids of tags already existing with another id are replaced
+    in tag_ids. """
+
+    for batch in chunks(raw_tags, batch_size):
+        existing_tags = Tag._get_collection().find({ '$or': [
+            { '_id': { '$in': [raw_tag['_id'] for raw_tag in batch] } }
+        ] + [
+            { '_cls': raw_tag['_cls'], 'name': raw_tag['name'] } for raw_tag in batch
+        ] }, { '_cls': True, 'name': True })
+        existing_ids = set()
+        existing_ids_by_type_and_name = {}
+
+        for existing_tag in existing_tags:
+            existing_ids.add(existing_tag['_id'])
+            existing_ids_by_type_and_name[(existing_tag['_cls'], existing_tag['name'])] = \
+                existing_tag['_id']
+
+        for raw_tag in batch:
+            existing_id = existing_ids_by_type_and_name.get((raw_tag['_cls'], raw_tag['name']))
+
+            if raw_tag['_id'] in existing_ids:
+                continue
+
+            if existing_id is None:
+                yield raw_tag
+            else:
+                tag_ids[raw_tag['_id']] = existing_id
+
+
+def import_graph(path, batch_size=1000):
+    """ Loads a file written by export_graph() with unordered bulk inserts: Tag documents first,
+    then DocumentTagRefs, in the current DocumentTagRefs.encoding. Tags and refs that already
+    exist are skipped, so an interrupted import can simply be run again. A tag whose name is
+    already used by an existing tag of the same type is skipped too, and its refs point at that
+    tag instead. The tagged documents are not part of the file, but their classes must be
+    defined. Returns how many tags and refs were inserted. """
+
+    index = read_graph_index(path)
+    sections = index['sections']
+    types = index['types']
+    ids = [bson.ObjectId(data[i:i + 12])
+           for data in _read_graph_section(path, sections['ids'], 12 * batch_size)
+           for i in range(0, len(data), 12)]
+    id_types = list(_read_graph_column(path, sections['id_types'], 'i', batch_size))
+
+    remapped_ids = {}
+    tags = _insert_graph_documents(
+        Tag._get_collection(),
+        _new_graph_tags(_read_graph_bson(path, sections['tags']), remapped_ids, batch_size),
+        batch_size)
+    ids = [remapped_ids.get(object_id, object_id) for object_id in ids]
+
+    def raw_refs(tag_class_name):
+        columns = [
+            _read_graph_column(path, sections['edges/%s/%s' % (tag_class_name, name)],
+                               pack_format, batch_size)
+            for name, dtype, pack_format in GRAPH_EDGE_COLUMNS
+        ]
+
+        for document_index, tag_index, tagged_at, expires_at in itertools.izip(*columns):
+            raw_ref = document_ref_update(types[id_types[document_index]],
+                                          ids[document_index])['$set']
+            raw_ref['tag'] = ids[tag_index]
+
+            if tagged_at != -1:
+                raw_ref['tagged_at'] = _datetime(tagged_at)
+
+            if expires_at != -1:
+                raw_ref['expires_at'] = _datetime(expires_at)
+
+            yield raw_ref
+
+    refs = 0
+    tag_class_names = sorted(set(name.split('/')[1] for name in sections
+                                 if name.startswith('edges/')))
+
+    for tag_class_name in tag_class_names:
+        refs += _insert_graph_documents(DocumentTagRefs._get_collection(),
+                                        raw_refs(tag_class_name), batch_size)
+
+    return tags, refs
@@ -34,8 +34,8 @@ class Student(Document, TaggableDocument):
 if __name__ == '__main__':
     connect('tag_spike')
 
-    # Since MongoEngine doesn't seem to allow this particular index in the meta definition (see
-    # DocumentTagRefs class definition above), create it directly in PyMongo.
+    # Since the document side indexes depend on DocumentTagRefs.encoding, they are not in the meta
+    # definition (see DocumentTagRefs class definition), so create them directly in PyMongo.
     create_document_tag_refs_cls_indexes()
 
     cassiano = Student(name='Cassiano D`Andrea').save()
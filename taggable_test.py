@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-import unittest
+import unittest, datetime, os, tempfile
 from taggable import *
 
 
@@ -22,6 +22,7 @@ class TestCase(unittest.TestCase):
             if not collection_name.startswith("system."):
                 self.db.drop_collection(collection_name)
 
+        clear_document_type_codes_cache()
         recreate_indexes()
 
 
@@ -459,6 +460,555 @@ class TestTaggable(TestCase):
         self.assertEqual(set(men_shoes.tags_by_type(EndOfCollectionSale)), set([snow_shoes_sale]))
         self.assertEqual(set(men_shoes.tags_by_type(NewCollection)), set([new_winter_collection]))
 
+    def test_buffered_tagger_writes_queued_tags_on_flush(self):
+        class Sale(Tag):
+            pass
+
+        class MenClothing(Document, TaggableDocument):
+            name = StringField(required=True)
+
+
+        summer_sale = Sale(name='Summer Sale').save()
+        men_shoes = MenClothing(name='Shoes').save()
+        pants = MenClothing(name='Pants').save()
+
+        with BufferedTagger(flush_interval=60) as tagger:
+            tagger.add_tag(men_shoes, summer_sale)
+            tagger.add_tag(pants, summer_sale)
+            tagger.flush()
+
+            self.assertEqual(
+                set(summer_sale.documents_by_type(MenClothing)), set([men_shoes, pants])
+            )
+
+            tagger.remove_tag(pants, summer_sale)
+
+        self.assertEqual(set(summer_sale.documents_by_type(MenClothing)), set([men_shoes]))
+
+    def test_buffered_tagger_checks_type_rules_when_queueing(self):
+        class Sale(Tag):
+            pass
+
+        class SpringCollection(Tag):
+            pass
+
+        class MenClothing(Document, TaggableDocument):
+            allowed_tags = [Sale]
+
+            name = StringField(required=True)
+
+
+        spring_collection = SpringCollection(name='Spring Collection').save()
+        men_shoes = MenClothing(name='Shoes').save()
+
+        with BufferedTagger() as tagger:
+            with self.assertRaises(TypeError):
+                tagger.add_tag(men_shoes, spring_collection)
+
+    def test_buffered_tagger_reports_bulk_write_failures_per_operation(self):
+        class Sale(Tag):
+            pass
+
+        class MenClothing(Document, TaggableDocument):
+            name = StringField(required=True)
+
+
+        summer_sale = Sale(name='Summer Sale').save()
+        winter_sale = Sale(name='Winter Sale').save()
+        men_shoes = MenClothing(name='Shoes').save()
+        failures = []
+
+        with BufferedTagger(callback=lambda operation: failures.append(operation.exception())) \
+                as tagger:
+            first = tagger.add_tag(men_shoes, summer_sale)
+            duplicate = tagger.add_tag(men_shoes, summer_sale)
+            after_duplicate = tagger.add_tag(men_shoes, winter_sale)
+
+        self.assertIsNone(first.exception())
+        self.assertIsInstance(duplicate.exception(), NotUniqueError)
+        self.assertIsNone(after_duplicate.exception())
+        self.assertEqual(len([failure for failure in failures if failure]), 1)
+        self.assertEqual(set(men_shoes.tags()), set([summer_sale, winter_sale]))
+
+    def test_buffered_tagger_checks_limits_when_writing(self):
+        class Sale(Tag):
+            pass
+
+        class MenClothing(Document, TaggableDocument):
+            allowed_tags = [(Sale, 1)]
+
+            name = StringField(required=True)
+
+
+        summer_sale = Sale(name='Summer Sale').save()
+        winter_sale = Sale(name='Winter Sale').save()
+        men_shoes = MenClothing(name='Shoes').save()
+
+        with BufferedTagger() as tagger:
+            first = tagger.add_tag(men_shoes, summer_sale)
+            over_limit = tagger.add_tag(men_shoes, winter_sale)
+
+        self.assertIsNone(first.exception())
+        self.assertIsInstance(over_limit.exception(), ValueError)
+        self.assertEqual(men_shoes.tags(), [summer_sale])
+
+    def test_merge_into_moves_refs_and_drops_duplicates(self):
+        class Sale(Tag):
+            pass
+
+        class MenClothing(Document, TaggableDocument):
+            name = StringField(required=True)
+
+
+        summer_sale = Sale(name='Summer Sale').save()
+        duplicated_summer_sale = Sale(name='Sumer Sale').save()
+        season_sale = Sale(name='Season Sale').save()
+        men_shoes = MenClothing(name='Shoes').save()
+        pants = MenClothing(name='Pants').save()
+
+        summer_sale.add_document(men_shoes)
+        duplicated_summer_sale.add_document(men_shoes)
+        duplicated_summer_sale.add_document(pants)
+        duplicated_summer_sale.add_tag(season_sale)
+        progress = []
+
+        duplicated_summer_sale.merge_into(summer_sale, batch_size=1,
+            progress=lambda processed, total: progress.append((processed, total)))
+
+        self.assertEqual(set(summer_sale.documents_by_type(MenClothing)), set([men_shoes, pants]))
+        self.assertEqual(summer_sale.tags(), [season_sale])
+        self.assertEqual(Sale.objects(name='Sumer Sale').count(), 0)
+        self.assertEqual(progress, [(1, 3), (2, 3), (3, 3)])
+
+    def test_merge_into_checks_document_limits(self):
+        class Sale(Tag):
+            allowed_documents = [('MenClothing', 1)]
+
+        class MenClothing(Document, TaggableDocument):
+            name = StringField(required=True)
+
+
+        summer_sale = Sale(name='Summer Sale').save()
+        duplicated_summer_sale = Sale(name='Sumer Sale').save()
+        men_shoes = MenClothing(name='Shoes').save()
+        pants = MenClothing(name='Pants').save()
+
+        summer_sale.add_document(men_shoes)
+        duplicated_summer_sale.add_document(pants)
+
+        with self.assertRaises(ValueError):
+            duplicated_summer_sale.merge_into(summer_sale)
+
+        self.assertEqual(duplicated_summer_sale.documents(), [pants])
+
+    def test_rename_merges_into_existing_tag_with_the_same_name(self):
+        class Sale(Tag):
+            pass
+
+        class MenClothing(Document, TaggableDocument):
+            name = StringField(required=True)
+
+
+        summer_sale = Sale(name='Summer Sale').save()
+        duplicated_summer_sale = Sale(name='Sumer Sale').save()
+        men_shoes = MenClothing(name='Shoes').save()
+
+        duplicated_summer_sale.add_document(men_shoes)
+
+        self.assertEqual(duplicated_summer_sale.rename('Summer Sale'), summer_sale)
+        self.assertEqual(summer_sale.documents(), [men_shoes])
+        self.assertEqual(summer_sale.rename('Summer Clearance').name, 'Summer Clearance')
+        self.assertEqual(Sale.objects.get(id=summer_sale.id).name, 'Summer Clearance')
+
+        with self.assertRaises(ValidationError):
+            summer_sale.rename('Summer Clearance' * 10)
+
+        self.assertEqual(summer_sale.name, 'Summer Clearance')
+
+    def test_rename_only_merges_into_tags_of_the_same_type(self):
+        class Sale(Tag):
+            pass
+
+        class Season(Tag):
+            pass
+
+        class MenClothing(Document, TaggableDocument):
+            name = StringField(required=True)
+
+
+        summer = Season(name='Summer').save()
+        summer_sale = Sale(name='Summer Sale').save()
+        duplicated_summer_sale = Sale(name='Sumer Sale').save()
+        men_shoes = MenClothing(name='Shoes').save()
+
+        duplicated_summer_sale.add_document(men_shoes)
+
+        self.assertEqual(summer_sale.rename('Summer'), summer_sale)
+        self.assertEqual(Sale.objects.get(id=summer_sale.id).name, 'Summer')
+        self.assertEqual(duplicated_summer_sale.rename('Summer'), summer_sale)
+        self.assertEqual(summer_sale.documents(), [men_shoes])
+        self.assertEqual(summer.documents(), [])
+        self.assertEqual(Season.objects.get(id=summer.id).name, 'Summer')
+
+    def test_facets_count_documents_by_tag_type(self):
+        class Year(Tag):
+            pass
+
+        class Class(Tag):
+            pass
+
+        class LabClass(Class):
+            pass
+
+        class Student(Document, TaggableDocument):
+            name = StringField(required=True)
+            grade = IntField()
+
+
+        third_grade = Year(name='3rd grade').save()
+        class_a = Class(name='A').save()
+        chemistry_lab = LabClass(name='Chemistry Lab').save()
+        students = [Student(name=name, grade=3).save() for name in ['Ana', 'Bia', 'Caio']]
+        Student(name='Duda', grade=4).save().add_tag(class_a)
+
+        for student in students:
+            student.add_tag(third_grade)
+            student.add_tag(class_a)
+
+        students[0].add_tag(chemistry_lab)
+
+        self.assertEqual(facets(Student.objects(grade=3), [Class, 'Year']), {
+            'Class': [(class_a, 3), (chemistry_lab, 1)],
+            'Year': [(third_grade, 3)]
+        })
+        self.assertEqual(facets([student.id for student in students[1:]], [Class], top=1,
+                                document_type=Student), {
+            'Class': [(class_a, 2)]
+        })
+
+        with self.assertRaises(TypeError):
+            facets([student.id for student in students], [Class])
+
+    def test_document_side_indexes_are_created_on_first_use(self):
+        DocumentTagRefs.drop_collection()
+        DocumentTagRefs._collection = None
+
+        indexes = DocumentTagRefs._get_collection().index_information()
+
+        self.assertTrue(indexes['document_1_tag_1']['unique'])
+        self.assertIn('document._cls_1', indexes)
+        self.assertNotIn('document_id_1_tag_1', indexes)
+
+    def test_compact_refs_work(self):
+        class Sale(Tag):
+            pass
+
+        class MenClothing(Document, TaggableDocument):
+            allowed_tags = [(Sale, 2)]
+
+            name = StringField(required=True)
+
+            meta = { 'allow_inheritance': True }
+
+        class YoungMenClothing(MenClothing):
+            pass
+
+        class WomenClothing(Document, TaggableDocument):
+            name = StringField(required=True)
+
+        DocumentTagRefs.encoding = COMPACT_REFS
+
+        try:
+            migrate_document_tag_refs()
+
+            self.assertNotIn('document_1_tag_1',
+                             DocumentTagRefs._get_collection().index_information())
+
+            summer_sale = Sale(name='Summer Sale').save()
+            winter_sale = Sale(name='Winter Sale').save()
+            black_friday = Sale(name='Black Friday').save()
+            men_shoes = MenClothing(name='Shoes').save()
+            snickers = YoungMenClothing(name='Snickers').save()
+            dress = WomenClothing(name='Dress').save()
+
+            summer_sale.add_document(men_shoes)
+            summer_sale.add_document(snickers)
+            summer_sale.add_document(dress)
+
+            with self.assertRaises(NotUniqueError):
+                men_shoes.add_tag(summer_sale)
+
+            men_shoes.add_tag(winter_sale)
+
+            with self.assertRaises(ValueError):
+                men_shoes.add_tag(black_friday)
+
+            self.assertEqual(
+                set(summer_sale.documents_by_type(MenClothing)), set([men_shoes, snickers])
+            )
+            self.assertEqual(summer_sale.documents_by_type(YoungMenClothing), [snickers])
+            self.assertEqual(set(men_shoes.tags()), set([summer_sale, winter_sale]))
+            self.assertNotIn('document', DocumentTagRefs._get_collection().find_one())
+        finally:
+            DocumentTagRefs.encoding = GENERIC_REFS
+
+    def test_refs_can_be_migrated_to_compact_encoding(self):
+        class Sale(Tag):
+            pass
+
+        class MenClothing(Document, TaggableDocument):
+            name = StringField(required=True)
+
+
+        summer_sale = Sale(name='Summer Sale').save()
+        men_shoes = MenClothing(name='Shoes').save()
+        pants = MenClothing(name='Pants').save()
+
+        summer_sale.add_document(men_shoes)
+
+        try:
+            DocumentTagRefs.encoding = DUAL_REFS
+            create_document_tag_refs_cls_indexes()
+            summer_sale.add_document(pants)
+
+            self.assertEqual(set(summer_sale.documents()), set([men_shoes, pants]))
+            self.assertEqual(migrate_document_tag_refs(DUAL_REFS), 1)
+            self.assertEqual(DocumentTagRefs._get_collection().find(
+                { 'document_id': { '$ne': None } }).count(), 2)
+
+            self.assertEqual(migrate_document_tag_refs(COMPACT_REFS), 2)
+            self.assertEqual(DocumentTagRefs._get_collection().find(
+                { 'document': { '$ne': None } }).count(), 0)
+
+            DocumentTagRefs.encoding = COMPACT_REFS
+            self.assertEqual(set(summer_sale.documents_by_type(MenClothing)),
+                             set([men_shoes, pants]))
+            self.assertEqual(pants.tags(), [summer_sale])
+        finally:
+            DocumentTagRefs.encoding = GENERIC_REFS
+
+    def test_expired_tags_are_ignored_and_can_be_added_again(self):
+        class Sale(Tag):
+            pass
+
+        class MenClothing(Document, TaggableDocument):
+            allowed_tags = [(Sale, 1)]
+
+            name = StringField(required=True)
+
+
+        summer_sale = Sale(name='Summer Sale').save()
+        winter_sale = Sale(name='Winter Sale').save()
+        men_shoes = MenClothing(name='Shoes').save()
+        a_minute_ago = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+
+        men_shoes.add_tag(summer_sale, expires_at=a_minute_ago)
+
+        self.assertEqual(men_shoes.tags(), [])
+        self.assertEqual(summer_sale.documents(), [])
+
+        men_shoes.add_tag(summer_sale)
+
+        self.assertEqual(men_shoes.tags(), [summer_sale])
+
+        with self.assertRaises(ValueError):
+            men_shoes.add_tag(winter_sale)
+
+    def test_buffered_tagger_replaces_expired_tags(self):
+        class Sale(Tag):
+            pass
+
+        class MenClothing(Document, TaggableDocument):
+            name = StringField(required=True)
+
+
+        summer_sale = Sale(name='Summer Sale').save()
+        men_shoes = MenClothing(name='Shoes').save()
+        a_minute_ago = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+
+        men_shoes.add_tag(summer_sale, expires_at=a_minute_ago)
+
+        with BufferedTagger() as tagger:
+            operation = tagger.add_tag(men_shoes, summer_sale)
+
+        self.assertIsNone(operation.exception())
+        self.assertEqual(men_shoes.tags(), [summer_sale])
+        self.assertEqual(DocumentTagRefs.objects.count(), 1)
+
+    def test_recent_documents_pages_newest_first(self):
+        class Sale(Tag):
+            pass
+
+        class MenClothing(Document, TaggableDocument):
+            name = StringField(required=True)
+
+
+        summer_sale = Sale(name='Summer Sale').save()
+        clothes = [MenClothing(name=name).save() for name in ['Shoes', 'Pants', 'Shirt', 'Tie']]
+        now = datetime.datetime.utcnow()
+
+        for minutes_ago, clothing in zip([90, 30, 20, 10], clothes):
+            ref = summer_sale.add_document(clothing)
+            ref.update(set__tagged_at=now - datetime.timedelta(minutes=minutes_ago))
+
+        last_hour = now - datetime.timedelta(hours=1)
+        documents, next_page = summer_sale.recent_documents(since=last_hour, limit=2)
+
+        self.assertEqual(documents, [clothes[3], clothes[2]])
+
+        documents, next_page = summer_sale.recent_documents(since=last_hour, limit=2,
+                                                            after=next_page)
+
+        self.assertEqual(documents, [clothes[1]])
+        self.assertIsNone(next_page)
+
+    def test_graph_can_be_exported_and_imported(self):
+        class Sale(Tag):
+            pass
+
+        class Season(Tag):
+            pass
+
+        class MenClothing(Document, TaggableDocument):
+            name = StringField(required=True)
+
+
+        summer_sale = Sale(name='Summer Sale').save()
+        summer = Season(name='Summer').save()
+        men_shoes = MenClothing(name='Shoes').save()
+        pants = MenClothing(name='Pants').save()
+
+        summer_sale.add_document(men_shoes)
+        summer_sale.add_document(pants)
+        summer_sale.add_tag(summer)
+        men_shoes.add_tag(summer, expires_at=datetime.datetime(2100, 1, 1))
+
+        descriptor, path = tempfile.mkstemp()
+        os.close(descriptor)
+
+        try:
+            export_graph(path, batch_size=1)
+
+            index = read_graph_index(path)
+
+            self.assertEqual(index['sections']['edges/Tag.Sale/documents']['shape'], [2])
+            self.assertEqual(index['sections']['edges/Tag.Season/tags']['shape'], [2])
+            self.assertEqual(len(index['types']), 3)
+
+            Tag.drop_collection()
+            DocumentTagRefs.drop_collection()
+            recreate_indexes()
+
+            self.assertEqual(import_graph(path), (2, 4))
+            self.assertEqual(import_graph(path), (0, 0))
+        finally:
+            os.remove(path)
+
+        self.assertEqual(set(summer_sale.documents_by_type(MenClothing)), set([men_shoes, pants]))
+        self.assertEqual(set(summer.documents()), set([summer_sale, men_shoes]))
+        self.assertEqual(DocumentTagRefs.objects.get(tag=summer, expires_at__ne=None).expires_at,
+                         datetime.datetime(2100, 1, 1))
+
+    def test_graph_import_reuses_existing_tags_with_the_same_type_and_name(self):
+        class Sale(Tag):
+            pass
+
+        class Season(Tag):
+            pass
+
+        class MenClothing(Document, TaggableDocument):
+            name = StringField(required=True)
+
+
+        exported_summer_sale = Sale(name='Summer Sale').save()
+        men_shoes = MenClothing(name='Shoes').save()
+
+        exported_summer_sale.add_document(men_shoes)
+
+        descriptor, path = tempfile.mkstemp()
+        os.close(descriptor)
+
+        try:
+            export_graph(path)
+
+            Tag.drop_collection()
+            DocumentTagRefs.drop_collection()
+            recreate_indexes()
+            Season(name='Summer Sale').save()
+            summer_sale = Sale(name='Summer Sale').save()
+
+            self.assertEqual(import_graph(path), (0, 1))
+        finally:
+            os.remove(path)
+
+        self.assertEqual(summer_sale.documents(), [men_shoes])
+        self.assertEqual(DocumentTagRefs.objects(tag=exported_summer_sale).count(), 0)
+
+    def test_graph_import_keeps_tags_named_like_tags_of_other_types(self):
+        class Sale(Tag):
+            pass
+
+        class Season(Tag):
+            pass
+
+
+        summer_sale = Sale(name='Summer').save()
+
+        descriptor, path = tempfile.mkstemp()
+        os.close(descriptor)
+
+        try:
+            export_graph(path)
+
+            Tag.drop_collection()
+            recreate_indexes()
+            summer = Season(name='Summer').save()
+
+            self.assertEqual(import_graph(path), (1, 0))
+        finally:
+            os.remove(path)
+
+        self.assertEqual(set(Tag.objects(name='Summer')), set([summer, summer_sale]))
+
+    def test_graph_arrays_can_be_memory_mapped(self):
+        try:
+            import numpy, numpy.testing
+        except ImportError:
+            self.skipTest('NumPy is not installed.')
+
+        class Sale(Tag):
+            pass
+
+        class MenClothing(Document, TaggableDocument):
+            name = StringField(required=True)
+
+
+        summer_sale = Sale(name='Summer Sale').save()
+        men_shoes = MenClothing(name='Shoes').save()
+        pants = MenClothing(name='Pants').save()
+
+        summer_sale.add_document(men_shoes)
+        summer_sale.add_document(pants)
+
+        descriptor, path = tempfile.mkstemp()
+        os.close(descriptor)
+
+        try:
+            export_graph(path)
+
+            index, arrays = load_graph(path)
+            ids = [bson.ObjectId(row.tobytes()) for row in arrays['ids']]
+            documents = arrays['edges/Tag.Sale/documents']
+
+            self.assertIsInstance(documents, numpy.memmap)
+            numpy.testing.assert_array_equal(
+                arrays['edges/Tag.Sale/tags'], [ids.index(summer_sale.id)] * 2)
+            self.assertEqual(set(ids[i] for i in documents), set([men_shoes.id, pants.id]))
+            self.assertEqual(index['types'][arrays['id_types'][ids.index(pants.id)]],
+                             'MenClothing')
+        finally:
+            os.remove(path)
+
 
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase(TestTaggable)